@@ -2,13 +2,30 @@ import pandas as pd
 import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import re
 import os
+import hashlib
 import glob
+import argparse
 
 INPUT_DIR = 'ParsedTranscripts'
+# Ticker-partitioned dataset from parse_transcripts.py --format parquet; read with --input-format parquet
+INPUT_DATASET = os.path.join(INPUT_DIR, 'transcripts.parquet')
 OUTPUT_DIR = 'TranscriptFeatures'
 MODEL_NAME = "ProsusAI/finbert"
+MAX_LENGTH = 512  # FinBERT context size, including [CLS] and [SEP]
+STRIDE = 128  # Tokens shared between consecutive chunks of a long text
+BATCH_SIZE = 32  # Number of 512-token chunks per forward pass
+PAD_MULTIPLE = 8  # Sequence lengths are padded to a multiple of this to hit Tensor Core kernels
+CACHE_FILE = 'finbert_cache.parquet'  # Sentiment probabilities from earlier runs, keyed by text hash
+
+# Columns read from the parsed transcript CSVs
+INPUT_COLUMNS = ['ticker', 'quarter', 'prepared_remarks', 'qa_management', 'word_count_qa_management']
+
+# Text columns scored by FinBERT (features are written as finbert_{column}_{pos,neg,neu})
+FINBERT_COLUMNS = ['prepared_remarks', 'qa_management']
 
 # Word Lists
 UNCERTAINTY_WORDS = [
@@ -23,101 +40,211 @@ FORWARD_LOOKING_WORDS = [
     'objective', 'upcoming'
 ]
 
-def count_words_from_list(text, word_list):
-    if not isinstance(text, str):
-        return 0
-    text = text.lower()
-    count = 0
-    for word in word_list:
-        count += len(re.findall(r'\b' + re.escape(word) + r'\b', text))
-    return count
-
-def get_finbert_sentiment(text, tokenizer, model, device):
-    if not isinstance(text, str) or not text.strip():
-        return {'positive': 0.0, 'negative': 0.0, 'neutral': 0.0}
-    
-    tokens = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512, stride=128, return_overflowing_tokens=True)
-    
-    input_ids = tokens['input_ids'].to(device)
-    attention_mask = tokens['attention_mask'].to(device)
-    
-    with torch.no_grad():
-        outputs = model(input_ids, attention_mask=attention_mask)
-        probs = torch.nn.functional.softmax(outputs.logits, dim=-1)
-        
-    avg_probs = probs.mean(dim=0).cpu().numpy()
-    
-    return {
-        'positive': avg_probs[0],
-        'negative': avg_probs[1],
-        'neutral': avg_probs[2]
-    }
+def build_word_pattern(word_list):
+    # One alternation matches every keyword in a single scan of the text
+    return r'\b(?:' + '|'.join(map(re.escape, word_list)) + r')\b'
+
+UNCERTAINTY_PATTERN = build_word_pattern(UNCERTAINTY_WORDS)
+FORWARD_LOOKING_PATTERN = build_word_pattern(FORWARD_LOOKING_WORDS)
+
+def chunk_token_ids(token_ids, cls_id, sep_id, max_length=MAX_LENGTH, stride=STRIDE):
+    # Splits one text's token ids into overlapping [CLS] ... [SEP] windows of at most max_length,
+    # the same chunks the tokenizer produces with return_overflowing_tokens=True
+    window = max_length - 2
+    step = window - stride
+    token_ids = np.asarray(token_ids, dtype=np.int64)
+    n_chunks = 1 + max(0, -(-(len(token_ids) - window) // step))
+    return [np.concatenate(([cls_id], token_ids[k * step:k * step + window], [sep_id])) for k in range(n_chunks)]
+
+def sentiment_cache_key(text, model_tag):
+    # The model tag (name + precision) is part of the key so fp16 / int8 results never mix with fp32 ones
+    return hashlib.sha256(f"{model_tag}\n{text}".encode('utf-8')).hexdigest()
+
+def load_sentiment_cache(path=CACHE_FILE):
+    # Returns {key: [pos, neg, neu]}; a missing or unreadable cache just means starting cold
+    if not os.path.exists(path):
+        return {}
+    try:
+        cache_df = pd.read_parquet(path)
+    except Exception as e:
+        print(f"Warning: could not read sentiment cache {path}: {e}")
+        return {}
+    return dict(zip(cache_df['key'], cache_df[['pos', 'neg', 'neu']].to_numpy()))
+
+def save_sentiment_cache(cache, path=CACHE_FILE):
+    probs = np.array(list(cache.values()), dtype=np.float64).reshape(-1, 3)
+    cache_df = pd.DataFrame({'key': list(cache), 'pos': probs[:, 0], 'neg': probs[:, 1], 'neu': probs[:, 2]})
+    # Write to a temporary file first so an interrupted run cannot leave a truncated cache behind
+    cache_df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+def get_finbert_sentiment_batch(texts, tokenizer, model, device, batch_size=BATCH_SIZE, cache=None, model_tag=MODEL_NAME):
+    # Returns an (n, 3) array of averaged [positive, negative, neutral] probabilities per text.
+    # All 512-token chunks of all texts are queued together, bucketed by length and run through
+    # the model in mini-batches, then averaged back per text.
+    # If a cache dict is given, previously scored texts are served from it and new results are added to it.
+    results = np.zeros((len(texts), 3))
+    valid = [i for i, text in enumerate(texts) if isinstance(text, str) and text.strip()]
+    if not valid:
+        return results
+
+    # Score each distinct text once and broadcast the result to its duplicates
+    unique_ids = {}
+    for i in valid:
+        unique_ids.setdefault(texts[i], len(unique_ids))
 
-def main():
+    unique_probs = np.zeros((len(unique_ids), 3))
+    if cache is None:
+        misses = list(range(len(unique_ids)))
+    else:
+        keys = [sentiment_cache_key(text, model_tag) for text in unique_ids]
+        misses = []
+        for job_id, key in enumerate(keys):
+            if key in cache:
+                unique_probs[job_id] = cache[key]
+            else:
+                misses.append(job_id)
+
+    if misses:
+        all_texts = list(unique_ids)
+        unique_probs[misses] = run_finbert([all_texts[j] for j in misses], tokenizer, model, device, batch_size)
+        if cache is not None:
+            for job_id in misses:
+                cache[keys[job_id]] = unique_probs[job_id]
+
+    results[valid] = unique_probs[[unique_ids[texts[i]] for i in valid]]
+    return results
+
+def run_finbert(unique_texts, tokenizer, model, device, batch_size=BATCH_SIZE):
+    # Model pass behind get_finbert_sentiment_batch: (n, 3) probabilities for n non-empty texts
+    # Tokenize every text once, then cut the overlapping model windows out of the token ids
+    encoded = tokenizer(unique_texts, add_special_tokens=False, return_attention_mask=False, verbose=False)['input_ids']
+    chunks = []
+    chunk_job_ids = []
+    for job_id, token_ids in enumerate(encoded):
+        for chunk in chunk_token_ids(token_ids, tokenizer.cls_token_id, tokenizer.sep_token_id):
+            chunks.append(chunk)
+            chunk_job_ids.append(job_id)
+
+    # Sort chunks by true length so each mini-batch only pads to its own longest chunk
+    lengths = np.array([len(chunk) for chunk in chunks])
+    order = np.argsort(lengths, kind='stable')
+    job_ids = torch.tensor(chunk_job_ids)[torch.from_numpy(order)]
+
+    # Half precision and pinned-memory async copies are only worthwhile on CUDA
+    on_cuda = device.type == 'cuda'
+
+    # Probabilities are accumulated on the device so batches are not synchronized one by one
+    prob_sums = torch.zeros((len(unique_texts), 3), dtype=torch.float32, device=device)
+    device_job_ids = job_ids.to(device)
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=on_cuda):
+        for start in range(0, len(chunks), batch_size):
+            end = start + batch_size
+            batch = [chunks[k] for k in order[start:end]]
+            max_len = int(lengths[order[start:end]].max())
+            max_len = ((max_len + PAD_MULTIPLE - 1) // PAD_MULTIPLE) * PAD_MULTIPLE
+
+            batch_ids = torch.full((len(batch), max_len), tokenizer.pad_token_id, dtype=torch.long, pin_memory=on_cuda)
+            batch_mask = torch.zeros((len(batch), max_len), dtype=torch.long, pin_memory=on_cuda)
+            for row, chunk in enumerate(batch):
+                batch_ids[row, :len(chunk)] = torch.from_numpy(chunk)
+                batch_mask[row, :len(chunk)] = 1
+
+            outputs = model(batch_ids.to(device, non_blocking=True),
+                            attention_mask=batch_mask.to(device, non_blocking=True))
+            probs = torch.nn.functional.softmax(outputs.logits.float(), dim=-1)
+            prob_sums.index_add_(0, device_job_ids[start:end], probs)
+
+    chunk_counts = torch.bincount(job_ids, minlength=len(unique_texts)).unsqueeze(1)
+    return (prob_sums.cpu() / chunk_counts).numpy()
+
+def main(quantize=False, use_cache=True, input_format='csv'):
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
         
     print("Initializing FinBERT...")
     try:
         tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+        # SDPA dispatches to fused (flash / memory-efficient) attention kernels
+        model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME, attn_implementation='sdpa')
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         model.to(device)
         model.eval()
+        if device.type == 'cuda':
+            # TF32 for any matmuls left in fp32 on Ampere+
+            torch.set_float32_matmul_precision('high')
+            # fp16 weights plus a compiled graph; length bucketing keeps the set of
+            # input shapes small, so recompilation only happens a handful of times
+            model = torch.compile(model.half())
+        elif quantize:
+            # Dynamic INT8 Linear layers: smaller weights and faster int8 dot products on CPU
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
     except Exception as e:
         print(f"Error loading model: {e}")
         return
 
-    csv_files = glob.glob(os.path.join(INPUT_DIR, '*_transcript_data.csv'))
-    print(f"Found {len(csv_files)} transcript files to process.")
+    if device.type == 'cuda':
+        model_tag = f"{MODEL_NAME}:fp16"
+    elif quantize:
+        model_tag = f"{MODEL_NAME}:int8"
+    else:
+        model_tag = f"{MODEL_NAME}:fp32"
+    cache = load_sentiment_cache() if use_cache else None
+    if cache is not None:
+        print(f"Loaded {len(cache)} cached FinBERT results from {CACHE_FILE}")
+
+    if input_format == 'parquet':
+        if not os.path.isdir(INPUT_DATASET):
+            print(f"Error: Parquet dataset '{INPUT_DATASET}' not found. Run parse_transcripts.py --format parquet first.")
+            return
+        with os.scandir(INPUT_DATASET) as entries:
+            input_files = sorted(e.path for e in entries if e.name.startswith('ticker=') and e.is_dir())
+    else:
+        input_files = glob.glob(os.path.join(INPUT_DIR, '*_transcript_data.csv'))
+    print(f"Found {len(input_files)} transcript files to process.")
     
-    for file_path in csv_files:
+    for file_path in input_files:
         filename = os.path.basename(file_path)
-        ticker = filename.split('_')[0]
+        is_partition = filename.startswith('ticker=')
+        ticker = filename[len('ticker='):] if is_partition else filename.split('_')[0]
         output_file_csv = os.path.join(OUTPUT_DIR, f"{ticker}_features.csv")
         
         print(f"Processing {ticker} ({filename})...")
         try:
-            df = pd.read_csv(file_path)
-            
-            # Initialize columns
-            for col in ['finbert_prepared_remarks_pos', 'finbert_prepared_remarks_neg', 'finbert_prepared_remarks_neu',
-                        'finbert_qa_management_pos', 'finbert_qa_management_neg', 'finbert_qa_management_neu']:
-                df[col] = 0.0
-                
-            for col in ['uncertainty_count_qa_management', 'forward_looking_count_prepared_remarks', 'forward_looking_count_qa_management']:
-                df[col] = 0
+            if is_partition:
+                # The partition key lives in the directory name, not in the files
+                df = pd.read_parquet(file_path, columns=[c for c in INPUT_COLUMNS if c != 'ticker'])
+                df.insert(0, 'ticker', ticker)
+            else:
+                df = pd.read_csv(file_path, usecols=INPUT_COLUMNS, engine='pyarrow')
             
             total_rows = len(df)
-            for index, row in df.iterrows():
-                if index % 5 == 0:
-                   print(f"  Row {index + 1}/{total_rows}")
-                   
-                # Word Counts
-                df.at[index, 'uncertainty_count_qa_management'] = count_words_from_list(row.get('qa_management', ''), UNCERTAINTY_WORDS)
-                df.at[index, 'forward_looking_count_prepared_remarks'] = count_words_from_list(row.get('prepared_remarks', ''), FORWARD_LOOKING_WORDS)
-                df.at[index, 'forward_looking_count_qa_management'] = count_words_from_list(row.get('qa_management', ''), FORWARD_LOOKING_WORDS)
-                
-                # FinBERT
-                sent_pr = get_finbert_sentiment(row.get('prepared_remarks', ''), tokenizer, model, device)
-                df.at[index, 'finbert_prepared_remarks_pos'] = sent_pr['positive']
-                df.at[index, 'finbert_prepared_remarks_neg'] = sent_pr['negative']
-                df.at[index, 'finbert_prepared_remarks_neu'] = sent_pr['neutral']
-                
-                sent_qa = get_finbert_sentiment(row.get('qa_management', ''), tokenizer, model, device)
-                df.at[index, 'finbert_qa_management_pos'] = sent_qa['positive']
-                df.at[index, 'finbert_qa_management_neg'] = sent_qa['negative']
-                df.at[index, 'finbert_qa_management_neu'] = sent_qa['neutral']
-
-            # Z-score
-            if 'word_count_qa_management' in df.columns:
-                 # Check if zero variance
-                 std_len = df['word_count_qa_management'].std()
-                 if std_len > 0:
-                     mean_len = df['word_count_qa_management'].mean()
-                     df['qa_management_length_zscore'] = (df['word_count_qa_management'] - mean_len) / std_len
-                 else:
-                     df['qa_management_length_zscore'] = 0.0
+
+            # Word Counts: one vectorized regex count per (column, word list)
+            prepared_remarks = df['prepared_remarks'].fillna('').str.lower()
+            qa_management = df['qa_management'].fillna('').str.lower()
+            df['uncertainty_count_qa_management'] = qa_management.str.count(UNCERTAINTY_PATTERN)
+            df['forward_looking_count_prepared_remarks'] = prepared_remarks.str.count(FORWARD_LOOKING_PATTERN)
+            df['forward_looking_count_qa_management'] = qa_management.str.count(FORWARD_LOOKING_PATTERN)
+
+            # FinBERT: score every (row, column) text in one batched pass
+            texts = [text for col in FINBERT_COLUMNS for text in df[col].to_numpy()]
+            print(f"  Scoring {len(texts)} texts ({total_rows} rows x {len(FINBERT_COLUMNS)} columns)")
+            cached_before = len(cache) if cache is not None else 0
+            probs = get_finbert_sentiment_batch(texts, tokenizer, model, device, cache=cache, model_tag=model_tag)
+            if cache is not None and len(cache) > cached_before:
+                save_sentiment_cache(cache)
+            for k, col in enumerate(FINBERT_COLUMNS):
+                finbert_cols = [f'finbert_{col}_pos', f'finbert_{col}_neg', f'finbert_{col}_neu']
+                df[finbert_cols] = probs[k * total_rows:(k + 1) * total_rows]
+
+            # Z-score of Q&A length (sample std, ddof=1); zero or undefined variance maps to 0
+            qa_word_counts = df['word_count_qa_management'].to_numpy(dtype=np.float64)
+            std_len = qa_word_counts.std(ddof=1) if total_rows > 1 else 0.0
+            if std_len > 0:
+                df['qa_management_length_zscore'] = np.divide(np.subtract(qa_word_counts, qa_word_counts.mean()), std_len)
+            else:
+                df['qa_management_length_zscore'] = 0.0
             
             # Select features
             cols_to_keep = [
@@ -134,11 +261,20 @@ def main():
             available_cols = [c for c in cols_to_keep if c in df.columns]
             features_df = df[available_cols]
             
-            features_df.to_csv(output_file_csv, index=False)
+            pacsv.write_csv(pa.Table.from_pandas(features_df, preserve_index=False), output_file_csv)
             print(f"Saved features for {ticker} to {output_file_csv}")
             
         except Exception as e:
             print(f"Error processing {filename}: {e}")
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Extract FinBERT and keyword features from parsed transcripts')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Use dynamic INT8 quantization for CPU inference (ignored on CUDA)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'Ignore and do not update the sentiment cache ({CACHE_FILE})')
+    parser.add_argument('--input-format', choices=['csv', 'parquet'], default='csv',
+                        help=f"Read the per-ticker CSVs (default) or the dataset {INPUT_DATASET}; match parse_transcripts.py --format")
+    args = parser.parse_args()
+    
+    main(quantize=args.quantize, use_cache=not args.no_cache, input_format=args.input_format)
@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta, date
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
 import re
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, List, Dict, Any
 
 # --- Configuration & Constants ---
@@ -12,22 +15,19 @@ OUTPUT_DIR = 'EarningsReturns'
 
 # Regex to detect quarters in text (e.g., "Q1 2024")
 QUARTER_PATTERN = re.compile(r'(Q[1-4]\s+\d{4})')
+# The quarter must appear within this many lines of the top (same rule as parse_transcripts.py)
+QUARTER_SEARCH_LINES = 20
 
 
-def parse_date_from_filename(filename: str) -> Optional[date]:
+def parse_dates_from_filenames(filenames: List[str]) -> pd.DatetimeIndex:
     """
-    Parses the earnings date from the transcript filename.
+    Parses the earnings dates from transcript filenames in one vectorized call.
     Expected format: YYYY-Mon-DD-TICKER.txt (e.g., 2023-Oct-25-AMD.txt)
+    Filenames that do not match the format yield NaT.
     """
-    try:
-        parts = filename.split('-')
-        if len(parts) >= 3:
-            # Construct date string: Year-Month-Day
-            date_str = f"{parts[0]}-{parts[1]}-{parts[2]}"
-            return datetime.strptime(date_str, '%Y-%b-%d').date()
-    except (ValueError, IndexError):
-        pass
-    return None
+    # Construct date strings: Year-Month-Day
+    date_strs = ['-'.join(f.split('-')[:3]) for f in filenames]
+    return pd.DatetimeIndex(pd.to_datetime(date_strs, format='%Y-%b-%d', errors='coerce'))
 
 
 def extract_quarter_from_file(file_path: str) -> Optional[str]:
@@ -37,8 +37,8 @@ def extract_quarter_from_file(file_path: str) -> Optional[str]:
     """
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            # Read only the first 20 lines to avoid processing the whole file
-            lines = [f.readline() for _ in range(20)]
+            # Read only the first lines to avoid processing the whole file
+            lines = list(itertools.islice(f, QUARTER_SEARCH_LINES))
             
         for line in lines:
             match = QUARTER_PATTERN.search(line)
@@ -50,142 +50,169 @@ def extract_quarter_from_file(file_path: str) -> Optional[str]:
     return None
 
 
-def load_stock_data(ticker: str) -> Optional[pd.DataFrame]:
+def write_stock_cache(df: pd.DataFrame, cache_file: str) -> None:
+    """
+    Writes the parsed stock data cache via a temporary file, so an interrupted write never
+    leaves a truncated cache that looks fresh. A failed write only costs the cache.
     """
-    Loads and preprocesses stock data for a given ticker.
-    Returns a DataFrame with a 'Date' column normalized to datetime.date objects, 
+    try:
+        df.to_parquet(cache_file + '.tmp', index=False)
+        os.replace(cache_file + '.tmp', cache_file)
+    except Exception as e:
+        print(f"Warning: could not write stock data cache {cache_file}: {e}")
+
+
+def load_stock_data(ticker: str, stock_file: Optional[str]) -> Optional[pd.DataFrame]:
+    """
+    Loads and preprocesses stock data for a given ticker from `stock_file` 
+    (None if the ticker has no stock data CSV).
+    Returns a DataFrame indexed by 'Date' (datetime64, normalized to midnight UTC), 
     sorted by date.
+    
+    Only the 'Date' and 'Close' columns are read. The parsed columns are cached 
+    next to the CSV as {ticker}.parquet and reused until the CSV is modified.
     """
-    stock_file = os.path.join(STOCK_DATA_DIR, f"{ticker}.csv")
-    if not os.path.exists(stock_file):
-        print(f"Stock data for {ticker} not found at {stock_file}. Skipping.")
+    if stock_file is None:
+        expected_file = os.path.join(STOCK_DATA_DIR, f"{ticker}.csv")
+        print(f"Stock data for {ticker} not found at {expected_file}. Skipping.")
         return None
 
+    cache_file = os.path.splitext(stock_file)[0] + '.parquet'
     try:
-        df = pd.read_csv(stock_file)
-        # Convert Date column to datetime objects, then extract the date part
-        # UTC=True is used to handle potential timezone awareness in source data
-        df['Date'] = pd.to_datetime(df['Date'], utc=True).dt.date
-        df = df.sort_values('Date').reset_index(drop=True)
+        cache_is_fresh = os.path.getmtime(cache_file) >= os.path.getmtime(stock_file)
+    except OSError:
+        cache_is_fresh = False
+
+    df = None
+    if cache_is_fresh:
+        try:
+            df = pd.read_parquet(cache_file, columns=['Date', 'Close'])
+        except Exception as e:
+            # A damaged cache is rebuilt from the CSV below
+            print(f"Warning: could not read stock data cache {cache_file}: {e}")
+            
+    try:
+        if df is None:
+            df = pd.read_csv(stock_file, usecols=['Date', 'Close'], engine='pyarrow')
+            # UTC=True is used to handle potential timezone awareness in source data
+            df['Date'] = pd.to_datetime(df['Date'], utc=True)
+            write_stock_cache(df, cache_file)
+            
+        # Keep the date part as datetime64 (not datetime.date objects) for fast comparisons
+        df['Date'] = df['Date'].dt.tz_localize(None).dt.normalize()
+        df = df.set_index('Date').sort_index()
         return df
     except Exception as e:
         print(f"Error loading stock data for {ticker}: {e}")
         return None
 
 
-def calculate_window_return(
-    df: pd.DataFrame, 
-    start_idx: int, 
+def calculate_window_returns(
+    close: np.ndarray, 
+    start_idx: np.ndarray, 
     window_days: int
-) -> Optional[float]:
+) -> np.ndarray:
     """
-    Calculates the return over a specific window (e.g., 1 day, 5 days).
+    Calculates the return over a specific window (e.g., 1 day, 5 days) 
+    for every earnings date at once.
     
     Args:
-        df: Stock DataFrame
-        start_idx: The index of the earnings date (t=0)
+        close: Closing prices, sorted by date
+        start_idx: The indices of the earnings dates (t=0)
         window_days: Number of days forward to calculate return for
         
     Returns:
-        The percentage return (e.g., 0.05 for 5%) or None if data is insufficient.
+        The percentage returns (e.g., 0.05 for 5%), NaN where data is insufficient.
     """
     target_idx = start_idx + window_days
     
-    # Ensure the target index is within bounds of the DataFrame
-    if target_idx < len(df):
-        price_t = df.at[start_idx, 'Close']
-        price_target = df.at[target_idx, 'Close']
-        
-        if price_t == 0: # Avoid division by zero
-            return None
-            
-        return (price_target - price_t) / price_t
+    # Ensure the target index is within bounds of the price series
+    in_bounds = target_idx < len(close)
+    price_t = close[start_idx]
+    price_target = close[np.where(in_bounds, target_idx, start_idx)]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = (price_target - price_t) / price_t
         
-    return None
+    # Avoid division by zero
+    returns[~in_bounds | (price_t == 0)] = np.nan
+    return returns
 
 
-def find_trading_day_index(
-    df: pd.DataFrame, 
-    target_date: date, 
+def find_trading_day_indices(
+    trading_dates: pd.DatetimeIndex, 
+    target_dates: pd.DatetimeIndex, 
     max_lookahead: int = 5
-) -> Optional[int]:
+) -> np.ndarray:
     """
-    Finds the index of the target date in the DataFrame.
-    If the target date is not a trading day (e.g., weekend/holiday),
-    searches for the next available trading day within `max_lookahead` days.
+    Finds the index of each target date in the sorted trading dates.
+    If a target date is not a trading day (e.g., weekend/holiday),
+    the next available trading day within `max_lookahead` days is used.
+    Returns -1 where no trading day is found.
     """
-    # First, try to find the exact date
-    idx_list = df.index[df['Date'] == target_date].tolist()
-    if idx_list:
-        return idx_list[0]
+    if len(trading_dates) == 0:
+        return np.full(len(target_dates), -1)
+        
+    # First trading day on or after each target date
+    positions = trading_dates.searchsorted(target_dates)
+    in_bounds = positions < len(trading_dates)
     
-    # If not found, look ahead for the next trading day
-    for i in range(1, max_lookahead + 1):
-        next_date = target_date + timedelta(days=i)
-        idx_list = df.index[df['Date'] == next_date].tolist()
-        if idx_list:
-            return idx_list[0]
-            
-    return None
+    matched = trading_dates[np.where(in_bounds, positions, 0)]
+    gaps = matched - target_dates
+    within_lookahead = in_bounds & (gaps <= pd.Timedelta(days=max_lookahead))
+    
+    return np.where(within_lookahead, positions, -1)
 
 
-def process_ticker(ticker: str):
+def process_ticker(ticker: str, stock_file: Optional[str]):
     """
     Processes a single ticker: finds transcripts, matches with stock data,
     calculates returns, and saves the result to a CSV.
     """
     print(f"Processing {ticker}...")
     
-    stock_df = load_stock_data(ticker)
+    stock_df = load_stock_data(ticker, stock_file)
     if stock_df is None:
         return
 
     ticker_dir = os.path.join(TRANSCRIPTS_DIR, ticker)
-    if not os.path.isdir(ticker_dir):
+    with os.scandir(ticker_dir) as entries:
+        transcript_files = [e.name for e in entries if e.name.endswith('.txt')]
+    
+    # 1. Earnings dates from the filenames
+    earnings_dates = parse_dates_from_filenames(transcript_files)
+    has_date = earnings_dates.notna()
+    dated_files = [f for f, keep in zip(transcript_files, has_date) if keep]
+    
+    if not dated_files:
         return
-
-    transcript_files = [f for f in os.listdir(ticker_dir) if f.endswith('.txt')]
-    results = []
-
-    for filename in transcript_files:
-        earnings_date = parse_date_from_filename(filename)
         
-        if not earnings_date:
-            continue
-            
-        # 1. content parsing
-        quarter = extract_quarter_from_file(os.path.join(ticker_dir, filename))
-        
-        # 2. Match with stock data
-        start_idx = find_trading_day_index(stock_df, earnings_date)
-        
-        if start_idx is None:
-            # Date (and near future dates) not found in stock data
-            continue
+    # 2. Match with stock data
+    start_idx = find_trading_day_indices(stock_df.index, earnings_dates[has_date])
+    matched = start_idx >= 0  # Date (and near future dates) found in stock data
+    start_idx = start_idx[matched]
+    
+    if not matched.any():
+        return
         
-        # Retrieve the actual date used (in case we moved forward)
-        actual_date = stock_df.at[start_idx, 'Date']
-
-        # 3. Calculate returns for different windows
-        ret_1d = calculate_window_return(stock_df, start_idx, 1)
-        ret_5d = calculate_window_return(stock_df, start_idx, 5)
-        ret_10d = calculate_window_return(stock_df, start_idx, 10)
-
-        results.append({
-            'ticker': ticker,
-            'quarter': quarter,
-            'earnings_date': actual_date, # The trading date used for t=0
-            'original_filename': filename,
-            '1_day_return': ret_1d,
-            '5_day_return': ret_5d,
-            '10_day_return': ret_10d
-        })
-
-    if results:
-        results_df = pd.DataFrame(results)
-        output_csv = os.path.join(OUTPUT_DIR, f"{ticker}_returns.csv")
-        results_df.to_csv(output_csv, index=False)
-        print(f"  Saved returns to {output_csv}")
+    # 3. Calculate returns for different windows
+    close = stock_df['Close'].to_numpy()
+    matched_files = [f for f, keep in zip(dated_files, matched) if keep]
+    
+    results_df = pd.DataFrame({
+        'ticker': ticker,
+        'quarter': [extract_quarter_from_file(os.path.join(ticker_dir, f)) for f in matched_files],
+        'earnings_date': stock_df.index[start_idx].date, # The trading date used for t=0
+        'original_filename': matched_files,
+        '1_day_return': calculate_window_returns(close, start_idx, 1),
+        '5_day_return': calculate_window_returns(close, start_idx, 5),
+        '10_day_return': calculate_window_returns(close, start_idx, 10)
+    })
+    
+    output_csv = os.path.join(OUTPUT_DIR, f"{ticker}_returns.csv")
+    # Arrow's C++ CSV writer avoids pandas' per-cell Python formatting
+    pacsv.write_csv(pa.Table.from_pandas(results_df, preserve_index=False), output_csv)
+    print(f"  Saved returns to {output_csv}")
 
 
 def calculate_returns():
@@ -205,16 +232,24 @@ def calculate_returns():
         print(f"Error: Transcripts directory '{TRANSCRIPTS_DIR}' not found.")
         return
 
-    tickers = [
-        d for d in os.listdir(TRANSCRIPTS_DIR) 
-        if os.path.isdir(os.path.join(TRANSCRIPTS_DIR, d))
-    ]
-    tickers.sort()
+    # Single directory scans
+    with os.scandir(TRANSCRIPTS_DIR) as entries:
+        tickers = sorted(e.name for e in entries if e.is_dir())
+        
+    with os.scandir(STOCK_DATA_DIR) as entries:
+        stock_files = {
+            e.name[:-len('.csv')]: e.path for e in entries 
+            if e.name.endswith('.csv') and e.is_file()
+        }
     
     print(f"Calculating returns for {len(tickers)} tickers...")
+    if not tickers:
+        return
     
-    for ticker in tickers:
-        process_ticker(ticker)
+    # Each ticker reads its own stock data and writes its own CSV, so they can run in parallel
+    max_workers = min(len(tickers), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(process_ticker, tickers, [stock_files.get(t) for t in tickers]))
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import yfinance as yf
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
-import time
 
 TRANSCRIPTS_DIR = 'Transcripts'
 OUTPUT_DIR = 'StockData'
@@ -20,32 +21,43 @@ def fetch_stock_data():
     tickers = get_tickers()
     print(f"Found {len(tickers)} tickers: {tickers}")
     
+    tickers_needed = []
     for ticker in tickers:
         output_file = os.path.join(OUTPUT_DIR, f"{ticker}.csv")
         
         # Skip if already exists (optional, but good for resuming)
         if os.path.exists(output_file):
             print(f"Data for {ticker} already exists. Skipping...")
-            continue
-            
-        print(f"Fetching data for {ticker}...")
-        try:
-            ticker_data = yf.Ticker(ticker)
-            # Fetching max history to ensure coverage
-            # Using auto_adjust=True to get split-adjusted prices which is generally better for returns
-            hist = ticker_data.history(period="max", auto_adjust=True)
-            
-            if hist.empty:
-                print(f"No data found for {ticker}")
-            else:
-                hist.to_csv(output_file)
-                print(f"Saved {ticker} data to {output_file}")
-                
-            # don't spam API
-            time.sleep(1)
-            
-        except Exception as e:
-            print(f"Error fetching data for {ticker}: {e}")
+        else:
+            tickers_needed.append(ticker)
+    
+    if not tickers_needed:
+        return
+    
+    print(f"Fetching data for {len(tickers_needed)} tickers...")
+    try:
+        # One batched request instead of a sleep-paced loop; yfinance fetches the tickers
+        # on its own thread pool. Fetching max history to ensure coverage, with
+        # auto_adjust=True to get split-adjusted prices which is generally better for returns.
+        # actions/ignore_tz keep the same columns and exchange-local dates as Ticker.history().
+        data = yf.download(tickers_needed, period="max", auto_adjust=True, actions=True, ignore_tz=False,
+                           group_by='ticker', threads=True, progress=False)
+    except Exception as e:
+        print(f"Error fetching data: {e}")
+        return
+    
+    fetched = set(data.columns.get_level_values(0)) if data is not None else set()
+    for ticker in tickers_needed:
+        output_file = os.path.join(OUTPUT_DIR, f"{ticker}.csv")
+        
+        # The batch shares one date index, so drop the dates this ticker has no price for
+        hist = data[ticker].dropna(subset=['Close']) if ticker in fetched else pd.DataFrame()
+        
+        if hist.empty:
+            print(f"No data found for {ticker}")
+        else:
+            pacsv.write_csv(pa.Table.from_pandas(hist.reset_index()), output_file)
+            print(f"Saved {ticker} data to {output_file}")
 
 if __name__ == "__main__":
     fetch_stock_data()
@@ -0,0 +1,25 @@
+# Production server settings for the RAG web app:
+#   gunicorn -c gunicorn_conf.py rag_app:app
+import os
+
+bind = os.environ.get('RAG_BIND', '0.0.0.0:5001')
+
+# Requests spend most of their time waiting on OpenAI, so each worker process serves many at
+# once on threads. Threads (rather than gevent) need no monkey-patching of numpy, the OpenAI
+# client or rag_query's background threads.
+workers = 2 * (os.cpu_count() or 1) + 1
+worker_class = 'gthread'
+threads = 8
+
+# Streamed answers keep a request open for the whole generation
+timeout = 120
+keepalive = 5
+
+# Import the app (and load the index, below) once in the master; forked workers share the
+# metadata and filter arrays copy-on-write and the memory-mapped embeddings via the page cache
+preload_app = True
+
+
+def when_ready(server):
+    from rag_query import load_index
+    load_index()
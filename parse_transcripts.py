@@ -1,24 +1,58 @@
 import os
 import re
+import io
 import csv
 import sys
-from typing import List, Dict, Optional
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # --- Configuration & Constants ---
 TRANSCRIPTS_DIR = 'Transcripts'
 OUTPUT_DIR = 'ParsedTranscripts'
+# Ticker-partitioned Parquet dataset written instead of the per-ticker CSVs with --format parquet
+PARQUET_DATASET = os.path.join(OUTPUT_DIR, 'transcripts.parquet')
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB; rows carry whole transcript sections, far larger than the 8 KiB default
 
 # Detects "Q1 2020", "Q4 2023", etc.
 QUARTER_PATTERN = re.compile(r'(Q[1-4]\s+\d{4})')
-# Separator lines in the transcript file
-SECTION_SEPARATOR_PATTERN = re.compile(r'={30,}')  # "=============================="
-SPEAKER_SEPARATOR_PATTERN = re.compile(r'-{30,}')  # "------------------------------"
+QUARTER_SEARCH_LINES = 20  # The quarter must appear within this many lines of the top
+QUARTER_SEARCH_BYTES = 4096  # Head read used to reject files with no quarter before reading the rest
+# Separator lines in the transcript file: a line starting with at least 30 of the same character.
+# Plain prefix comparisons are cheaper than running the regex engine on every line.
+SECTION_SEPARATOR = '=' * 30  # "=============================="
+SPEAKER_SEPARATOR = '-' * 30  # "------------------------------"
+# Raw-bytes match for a section separator followed by a Definitions/Disclaimer title,
+# the point where parse_transcript() stops; everything after it never needs decoding
+DISCLAIMER_SECTION_PATTERN = re.compile(
+    rb'^[ \t]*={30,}[^\n]*\n(?:[ \t\r]*\n)*[^\n]*(?:definitions|disclaimer)[^\n]*',
+    re.IGNORECASE | re.MULTILINE
+)
 
 # Speaker Roles
 ROLE_MANAGEMENT = 'Management'
 ROLE_ANALYST = 'Analyst'
 ROLE_OPERATOR = 'Operator'
 
+# Title fragments that mark a speaker as management
+MANAGEMENT_TITLES = ('CEO', 'CFO', 'CTO', 'President', 'Officer',
+                     'Relations', 'Counsel', 'Controller', 'Vice President',
+                     'Chief', 'Manager', 'Director')
+# All titles in one alternation: a single C-level scan of the speaker line instead of one per title
+MANAGEMENT_TITLE_PATTERN = re.compile('|'.join(map(re.escape, MANAGEMENT_TITLES)))
+
+# Column order of the parsed transcript CSVs
+OUTPUT_FIELDNAMES = ['ticker', 'quarter',
+                     'word_count_prepared_remarks', 'word_count_qa_management', 'word_count_qa_analysts',
+                     'prepared_remarks', 'qa_management', 'qa_analysts']
+# One parsed transcript; a plain tuple in OUTPUT_FIELDNAMES order, so csv.writer takes it as is
+TranscriptRow = namedtuple('TranscriptRow', OUTPUT_FIELDNAMES)
+
 # Transcript Sections
 SECTION_PRESENTATION = 'Presentation'
 SECTION_QA = 'Q&A'
@@ -30,7 +64,7 @@ def extract_quarter(lines: List[str], filename: str) -> str:
     Falls back to parsing the filename if not found in the text.
     """
     # Check the first 20 lines for a quarter pattern
-    for line in lines[:20]:
+    for line in lines[:QUARTER_SEARCH_LINES]:
         match = QUARTER_PATTERN.search(line)
         if match:
             return match.group(1)
@@ -53,12 +87,7 @@ def determine_speaker_role(speaker_line: str) -> str:
     if 'Operator' in speaker_line:
         return ROLE_OPERATOR
 
-    # Management identifiers
-    management_titles = ['CEO', 'CFO', 'CTO', 'President', 'Officer', 
-                         'Relations', 'Counsel', 'Controller', 'Vice President', 
-                         'Chief', 'Manager', 'Director']
-    
-    if any(title in speaker_line for title in management_titles):
+    if MANAGEMENT_TITLE_PATTERN.search(speaker_line):
         return ROLE_MANAGEMENT
         
     if 'Analyst' in speaker_line:
@@ -69,37 +98,80 @@ def determine_speaker_role(speaker_line: str) -> str:
     return ROLE_ANALYST
 
 
-def parse_transcript(file_path: str, ticker: str) -> Dict:
+def append_line(buffer: io.StringIO, line: str) -> int:
+    """
+    Appends a content line to a section buffer, space-separated exactly like ' '.join,
+    and returns the line's word count.
+    """
+    if buffer.tell():
+        buffer.write(' ')
+    buffer.write(line)
+    return len(line.split())
+
+
+def parse_transcript(file_path: str, ticker: str) -> TranscriptRow:
     """
     Parses a single transcript file to extract prepared remarks and Q&A content.
+    Files with no quarter in their opening lines return early with an empty 'quarter'.
     """
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        lines = [line.strip() for line in f.readlines()]
+    with open(file_path, 'rb') as f:
+        head = f.read(QUARTER_SEARCH_BYTES)
+        # main() discards transcripts without a quarter. If the lines extract_quarter() would
+        # look at are all in the head and none has a quarter, skip reading the rest of the file.
+        head_lines = head.split(b'\n', QUARTER_SEARCH_LINES)
+        if len(head_lines) > QUARTER_SEARCH_LINES:
+            head_text = b'\n'.join(head_lines[:QUARTER_SEARCH_LINES]).decode('utf-8', errors='ignore')
+            if not QUARTER_PATTERN.search(head_text):
+                return TranscriptRow(ticker, '', 0, 0, 0, '', '', '')
+        raw = head + f.read()
+
+    # Drop the trailing legal boilerplate before decoding. The cut keeps the separator and
+    # title line, so the loop below still sees them and stops exactly where it did before.
+    match = DISCLAIMER_SECTION_PATTERN.search(raw)
+    if match:
+        title = match.group().lower()
+        if not (b'presentation' in title or b'questions and answers' in title or b'q&a' in title):
+            raw = raw[:match.end()]
+
+    # One decode and one split (with text-mode newline handling); every line is stripped once up front
+    text = raw.decode('utf-8', errors='ignore')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = [line.strip() for line in text.split('\n')]
 
     filename = os.path.basename(file_path)
     quarter = extract_quarter(lines, filename)
     
-    # Data accumulators
-    prepared_remarks = []
-    qa_management = []
-    qa_analysts = []
+    # Data accumulators: text goes straight into one buffer per section instead of a list
+    # of line strings that all stay alive until the final join
+    prepared_remarks = io.StringIO()
+    qa_management = io.StringIO()
+    qa_analysts = io.StringIO()
+    word_count_prepared_remarks = 0
+    word_count_qa_management = 0
+    word_count_qa_analysts = 0
     
     # State tracking
     current_section = None
     current_role = None
     
+    # Blank lines carry no content and every lookahead below skips them, so drop them once up
+    # front; the next non-blank line after i is then simply i + 1
+    lines = [line for line in lines if line]
+    n_lines = len(lines)
+    
     i = 0
-    while i < len(lines):
+    while i < n_lines:
         line = lines[i]
+        # Single-character strings are cached, so this costs no allocation; only lines that
+        # start with '=' or '-' go on to the full separator comparison
+        first_char = line[:1]
         
         # --- Case 1: Section Change (detected by "=====") ---
-        if SECTION_SEPARATOR_PATTERN.match(line):
+        if first_char == '=' and line.startswith(SECTION_SEPARATOR):
             # Look ahead to identified the new section title
             j = i + 1
-            while j < len(lines) and not lines[j]: # Skip empty lines
-                j += 1
-            
-            if j < len(lines):
+            if j < n_lines:
                 next_line_lower = lines[j].lower()
                 if 'presentation' in next_line_lower:
                     current_section = SECTION_PRESENTATION
@@ -111,21 +183,15 @@ def parse_transcript(file_path: str, ticker: str) -> Dict:
                     break # Stop parsing at the disclaimer
         
         # --- Case 2: Speaker Change (detected by "-----") ---
-        elif SPEAKER_SEPARATOR_PATTERN.match(line):
-             # Look ahead to find the speaker's name
+        elif first_char == '-' and line.startswith(SPEAKER_SEPARATOR):
+            # Look ahead to find the speaker's name
             j = i + 1
-            while j < len(lines) and not lines[j]: # Skip empty lines
-                j += 1
-            
-            if j < len(lines):
+            if j < n_lines:
                 speaker_name_line = lines[j]
                 
                 # Verify it's a valid speaker block (should be followed by another separator)
                 k = j + 1
-                while k < len(lines) and not lines[k]:
-                    k += 1
-                
-                if k < len(lines) and SPEAKER_SEPARATOR_PATTERN.match(lines[k]):
+                if k < n_lines and lines[k].startswith(SPEAKER_SEPARATOR):
                     # Valid speaker block found
                     current_role = determine_speaker_role(speaker_name_line)
                     
@@ -144,38 +210,78 @@ def parse_transcript(file_path: str, ticker: str) -> Dict:
         
         # --- Case 3: Content Line ---
         else:
-            if line and current_section and current_role != ROLE_OPERATOR:
-                # Filter out page numbers or timestamp artifacts if necessary
-                if line.isdigit() or line.startswith('Thomson Reuters'):
+            if current_section and current_role != ROLE_OPERATOR:
+                # Filter out page numbers or timestamp artifacts if necessary; the first character
+                # rules out almost every line before either method is called
+                if ((first_char == 'T' and line.startswith('Thomson Reuters'))
+                        or (first_char.isdigit() and line.isdigit())):
                     pass
                 else:
                     if current_section == SECTION_PRESENTATION:
-                        prepared_remarks.append(line)
+                        word_count_prepared_remarks += append_line(prepared_remarks, line)
                     elif current_section == SECTION_QA:
                         if current_role == ROLE_MANAGEMENT:
-                            qa_management.append(line)
+                            word_count_qa_management += append_line(qa_management, line)
                         elif current_role == ROLE_ANALYST:
-                            qa_analysts.append(line)
+                            word_count_qa_analysts += append_line(qa_analysts, line)
     
         i += 1
 
     # Compile results
-    return {
-        'ticker': ticker,
-        'quarter': quarter,
-        'prepared_remarks': ' '.join(prepared_remarks),
-        'qa_management': ' '.join(qa_management),
-        'qa_analysts': ' '.join(qa_analysts),
-        'word_count_prepared_remarks': len(' '.join(prepared_remarks).split()),
-        'word_count_qa_management': len(' '.join(qa_management).split()),
-        'word_count_qa_analysts': len(' '.join(qa_analysts).split())
-    }
+    return TranscriptRow(
+        ticker=ticker,
+        quarter=quarter,
+        word_count_prepared_remarks=word_count_prepared_remarks,
+        word_count_qa_management=word_count_qa_management,
+        word_count_qa_analysts=word_count_qa_analysts,
+        prepared_remarks=prepared_remarks.getvalue(),
+        qa_management=qa_management.getvalue(),
+        qa_analysts=qa_analysts.getvalue()
+    )
+
+
+def parse_transcript_job(file_path: str, ticker: str) -> Tuple[Optional[TranscriptRow], Optional[str]]:
+    """
+    Worker entry point for the process pool: returns (parsed data, None) or (None, error message),
+    so one bad file does not abort the rest of the batch.
+    """
+    try:
+        return parse_transcript(file_path, ticker), None
+    except Exception as e:
+        return None, str(e)
+
+
+def write_ticker_csv(ticker: str, rows: List[TranscriptRow]) -> str:
+    """
+    Writes one ticker's parsed transcripts to {ticker}_transcript_data.csv and returns the path.
+    """
+    output_csv_path = os.path.join(OUTPUT_DIR, f"{ticker}_transcript_data.csv")
+    
+    # Rows are already tuples in column order; DictWriter would look up every cell by key
+    with open(output_csv_path, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(OUTPUT_FIELDNAMES)
+        writer.writerows(rows)
+    return output_csv_path
+
+
+def write_ticker_parquet(ticker: str, rows: List[TranscriptRow]) -> str:
+    """
+    Replaces the ticker=<ticker> partition of the Parquet dataset with `rows` and returns
+    the partition path. The text columns are stored zstd-compressed and columnar, so
+    readers skip CSV quoting and decoding entirely.
+    """
+    table = pa.table({name: list(values) for name, values in zip(OUTPUT_FIELDNAMES, zip(*rows))})
+    pq.write_to_dataset(table, root_path=PARQUET_DATASET, partition_cols=['ticker'],
+                        compression='zstd', existing_data_behavior='delete_matching')
+    return os.path.join(PARQUET_DATASET, f"ticker={ticker}")
 
 
-def main():
+def main(output_format: str = 'csv'):
     """
     Main execution function. 
-    Iterates through all transcript files and aggregates parsed data into a CSV.
+    Iterates through all transcript files and aggregates parsed data into one CSV per ticker,
+    or into the ticker-partitioned Parquet dataset when output_format is 'parquet'.
     """
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
@@ -184,42 +290,49 @@ def main():
         print(f"Error: Directory '{TRANSCRIPTS_DIR}' not found.")
         return
 
-    tickers = [d for d in os.listdir(TRANSCRIPTS_DIR) if os.path.isdir(os.path.join(TRANSCRIPTS_DIR, d))]
-    tickers.sort()
+    # DirEntry caches the file type from readdir, so no extra stat per entry
+    with os.scandir(TRANSCRIPTS_DIR) as entries:
+        tickers = sorted(e.name for e in entries if e.is_dir())
     
     print(f"Index found: {len(tickers)} tickers.")
 
+    ticker_files = {}
     for ticker in tickers:
-        ticker_dir = os.path.join(TRANSCRIPTS_DIR, ticker)
-        files = [f for f in os.listdir(ticker_dir) if f.endswith('.txt')]
-        files.sort()
-        
-        parsed_data_list = []
-        print(f"Processing {ticker} ({len(files)} transcripts)...")
-        
-        for filename in files:
-            file_path = os.path.join(ticker_dir, filename)
-            try:
-                data = parse_transcript(file_path, ticker)
+        with os.scandir(os.path.join(TRANSCRIPTS_DIR, ticker)) as entries:
+            ticker_files[ticker] = sorted(e.name for e in entries if e.name.endswith('.txt') and e.is_file())
+
+    # Transcripts are independent and parsing is pure-Python CPU work, so spread it over processes.
+    # Every ticker's files are queued up front; results come back in submission order.
+    total_files = sum(len(files) for files in ticker_files.values())
+    with ProcessPoolExecutor(max_workers=max(1, min(total_files, os.cpu_count() or 1))) as pool:
+        ticker_results = [
+            (ticker, files, pool.map(parse_transcript_job,
+                                     [os.path.join(TRANSCRIPTS_DIR, ticker, f) for f in files], repeat(ticker)))
+            for ticker, files in ticker_files.items()
+        ]
+
+        for ticker, files, results in ticker_results:
+            parsed_data_list = []
+            print(f"Processing {ticker} ({len(files)} transcripts)...")
+
+            for filename, (data, error) in zip(files, results):
+                if error is not None:
+                    print(f"  Warning: Failed to parse {filename}: {error}")
                 # Only save if we successfully extracted a quarter
-                if data['quarter']: 
+                elif data.quarter:
                     parsed_data_list.append(data)
-            except Exception as e:
-                print(f"  Warning: Failed to parse {filename}: {e}")
-        
-        if parsed_data_list:
-            output_csv_path = os.path.join(OUTPUT_DIR, f"{ticker}_transcript_data.csv")
-            fieldnames = ['ticker', 'quarter', 
-                          'word_count_prepared_remarks', 'word_count_qa_management', 'word_count_qa_analysts', 
-                          'prepared_remarks', 'qa_management', 'qa_analysts']
-            
-            with open(output_csv_path, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in parsed_data_list:
-                    writer.writerow(row)
-            
-            print(f"  -> Saved to {output_csv_path}")
+
+            if parsed_data_list:
+                if output_format == 'parquet':
+                    output_path = write_ticker_parquet(ticker, parsed_data_list)
+                else:
+                    output_path = write_ticker_csv(ticker, parsed_data_list)
+                print(f"  -> Saved to {output_path}")
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Parse earnings call transcripts into per-section text')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help=f"Output per-ticker CSVs (default) or the ticker-partitioned dataset {PARQUET_DATASET}")
+    args = parser.parse_args()
+    
+    main(output_format=args.format)
@@ -1,13 +1,32 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
+from flask.json.provider import JSONProvider
+import hashlib
+import orjson
 import os
 import sys
 
 # Add current directory to path to ensure we can import rag_query
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from rag_query import query_rag
+from rag_query import query_rag, query_rag_stream
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, which serializes the large context payloads much faster."""
+    option = orjson.OPT_SERIALIZE_NUMPY
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Skip the bytes -> str -> bytes round trip of the default implementation
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # --- Embedded Frontend (HTML/CSS/JS) ---
 HTML_TEMPLATE = """
@@ -204,7 +223,7 @@ HTML_TEMPLATE = """
             resultsDiv.innerHTML = '';
 
             try {
-                const response = await fetch('/query', {
+                const response = await fetch('/query/stream', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
@@ -212,12 +231,52 @@ HTML_TEMPLATE = """
                     body: JSON.stringify({ query: query }),
                 });
 
-                const data = await response.json();
+                // Requests rejected before streaming starts come back as plain JSON
+                if (!response.ok) {
+                    const data = await response.json();
+                    showError(data.error);
+                    return;
+                }
 
-                if (data.error) {
-                    resultsDiv.innerHTML = `<div class="answer-card" style="color: red;">Error: ${data.error}</div>`;
-                } else {
-                    renderResults(data);
+                // Server-sent events: "data: {json}" frames separated by a blank line
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let pending = '';
+                let answer = '';
+                let renderScheduled = false;
+
+                const renderAnswer = () => {
+                    renderScheduled = false;
+                    document.getElementById('answerBody').innerHTML = marked.parse(answer);
+                };
+
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+
+                    pending += decoder.decode(value, { stream: true });
+                    const frames = pending.split('\\n\\n');
+                    pending = frames.pop();
+
+                    for (const frame of frames) {
+                        if (!frame.startsWith('data: ')) continue;
+                        const event = JSON.parse(frame.slice(6));
+
+                        if (event.error) {
+                            showError(event.error);
+                        } else if (event.context) {
+                            // Sources arrive first; the answer fills in below them as it streams
+                            loading.style.display = 'none';
+                            renderResults({ ...event, answer: '' });
+                        } else if (event.delta) {
+                            answer += event.delta;
+                            // Re-render the markdown at most once per frame
+                            if (!renderScheduled) {
+                                renderScheduled = true;
+                                requestAnimationFrame(renderAnswer);
+                            }
+                        }
+                    }
                 }
 
             } catch (error) {
@@ -228,6 +287,11 @@ HTML_TEMPLATE = """
             }
         }
 
+        function showError(message) {
+            const resultsDiv = document.getElementById('results');
+            resultsDiv.innerHTML = `<div class="answer-card" style="color: red;">Error: ${message}</div>`;
+        }
+
         function renderResults(data) {
             const resultsDiv = document.getElementById('results');
             
@@ -272,7 +336,7 @@ HTML_TEMPLATE = """
                 ${filtersHtml}
                 <div class="answer-card">
                     <div class="answer-header">Answer</div>
-                    <div class="markdown-body">${answerHtml}</div>
+                    <div class="markdown-body" id="answerBody">${answerHtml}</div>
                 </div>
                 ${contextHtml}
             `;
@@ -282,9 +346,20 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# The page has no per-request variables, so it is rendered once and served as fixed bytes
+with app.app_context():
+    HTML_BYTES = render_template_string(HTML_TEMPLATE).encode('utf-8')
+HTML_ETAG = hashlib.sha256(HTML_BYTES).hexdigest()[:16]
+HTML_MAX_AGE_SECONDS = 3600
+
 @app.route('/')
 def home():
-    return render_template_string(HTML_TEMPLATE)
+    response = Response(HTML_BYTES, mimetype='text/html')
+    response.set_etag(HTML_ETAG)
+    response.cache_control.public = True
+    response.cache_control.max_age = HTML_MAX_AGE_SECONDS
+    # Answers 304 Not Modified when the browser already holds this version
+    return response.make_conditional(request)
 
 @app.route('/query', methods=['POST'])
 def query_api():
@@ -301,6 +376,26 @@ def query_api():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/query/stream', methods=['POST'])
+def query_stream_api():
+    # Same as /query, but the answer is sent as server-sent events while it is generated
+    data = request.json
+    query = data.get('query')
+    if not query:
+        return jsonify({"error": "No query provided"}), 400
+    
+    def generate():
+        try:
+            for event in query_rag_stream(query):
+                yield b"data: " + orjson.dumps(event, option=OrjsonProvider.option) + b"\n\n"
+        except Exception as e:
+            yield b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Keep reverse proxies from buffering the stream
+    })
+
 if __name__ == '__main__':
     # Run on port 5001 to avoid macOS AirPlay conflict on 5000
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -1,9 +1,12 @@
 import os
 import glob
+import argparse
+import hashlib
 import pandas as pd
 import numpy as np
-import pickle
 import re
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv
@@ -13,18 +16,44 @@ load_dotenv()
 
 # --- Configuration ---
 TRANSCRIPTS_DIR = 'ParsedTranscripts'
+# Alternative to the CSVs above, written by parse_transcripts.py --format parquet
+TRANSCRIPTS_DATASET = os.path.join(TRANSCRIPTS_DIR, 'transcripts.parquet')
+# Raw transcripts, read only for each company's name
+RAW_TRANSCRIPTS_DIR = 'Transcripts'
 RETURNS_DIR = 'EarningsReturns'
 Signals_DIR = 'TranscriptFeatures'
-OUTPUT_INDEX = 'rag_index.pkl'
+# The index is a float32 embedding matrix plus a row-aligned metadata table
+OUTPUT_EMBEDDINGS = 'rag_index_embeddings.npy'
+OUTPUT_METADATA = 'rag_index_meta.parquet'
+# Transcript-level signals, one row per (ticker, quarter); chunks join to it on those columns
+OUTPUT_SIGNALS = 'rag_index_signals.parquet'
+# Company name per indexed ticker, so queries can name a company in place of its ticker
+OUTPUT_COMPANIES = 'rag_index_companies.parquet'
+# Raw embeddings from earlier builds, keyed by chunk text hash, so re-indexing only embeds new chunks
+EMBEDDING_CACHE_FILE = 'rag_embedding_cache.npz'
 EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
 CHUNK_SIZE_SENTENCES = 7  # Number of sentences per chunk
 OVERLAP_SENTENCES = 2     # Overlap between chunks
+EMBEDDING_BATCH_SIZE = 100
+# Embedding calls are network-bound, so several batches are kept in flight at once
+EMBEDDING_WORKERS = 8
+# Retries (exponential backoff, honoring Retry-After on 429s) are handled by the OpenAI client
+EMBEDDING_MAX_RETRIES = 6
+# Returns and features are joined onto transcripts by these columns
+MERGE_KEYS = ['ticker', 'quarter']
+# Sentence boundary: whitespace after '.' or '?', except after abbreviations like "e.g." or "Mr.".
+# The cheap '.'/'?' check comes first so most positions are rejected before the wider lookbehinds.
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.?])(?<!\w\.\w.)(?<![A-Z][a-z]\.)\s')
+# Transcript title line, e.g. "Q2 2016 Apple Inc Earnings Call", found within the first lines
+COMPANY_TITLE_PATTERN = re.compile(r'^Q[1-4]\s+\d{4}\s+(.+?)\s+Earnings Call', re.MULTILINE)
+COMPANY_TITLE_LINES = 20
 
 # Initialize OpenAI Client
 # Expecting OPENAI_API_KEY in environment variables
 # For this session, we will pass it if not found, but best practice is env var.
 try:
-    client = OpenAI()
+    client = OpenAI(max_retries=EMBEDDING_MAX_RETRIES)
 except Exception as e:
     print(f"Error initializing OpenAI client: {e}")
     print("Ensure OPENAI_API_KEY is set.")
@@ -41,14 +70,36 @@ def get_embeddings_batch(texts):
         return embeddings
     except Exception as e:
         print(f"Error getting batch embeddings: {e}")
-        return [[0.0] * 1536 for _ in texts]
+        return [[0.0] * EMBEDDING_DIM for _ in texts]
+
+def embedding_cache_key(text, model=EMBEDDING_MODEL):
+    # The model is part of the key so switching embedding models never reuses stale vectors
+    return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+def load_embedding_cache(path=EMBEDDING_CACHE_FILE):
+    # Returns {key: embedding row}
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as cache_file:
+            return dict(zip(cache_file['keys'].tolist(), cache_file['embeddings']))
+    except Exception as e:
+        print(f"Warning: could not read embedding cache {path}: {e}")
+        return {}
+
+def save_embedding_cache(cache, path=EMBEDDING_CACHE_FILE):
+    keys = np.array(list(cache), dtype=str)
+    embeddings = np.array(list(cache.values()), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, keys=keys, embeddings=embeddings)
+    os.replace(path + '.tmp', path)
 
 def chunk_text(text, chunk_size=CHUNK_SIZE_SENTENCES, overlap=OVERLAP_SENTENCES):
     if not isinstance(text, str):
         return []
     
     # Simple sentence splitting by period. Could be more robust with nltk/spacy.
-    sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', text)
+    sentences = SENTENCE_SPLIT_PATTERN.split(text)
     sentences = [s.strip() for s in sentences if s.strip()]
     
     chunks = []
@@ -63,30 +114,54 @@ def chunk_text(text, chunk_size=CHUNK_SIZE_SENTENCES, overlap=OVERLAP_SENTENCES)
             
     return chunks
 
-def load_data():
+def load_company_names(tickers):
+    # Returns {ticker: company name} from the title of the ticker's first raw transcript that has one
+    names = {}
+    for ticker in tickers:
+        for f in sorted(glob.glob(os.path.join(RAW_TRANSCRIPTS_DIR, ticker, '*.txt'))):
+            try:
+                with open(f, 'r', encoding='utf-8', errors='ignore') as fh:
+                    match = COMPANY_TITLE_PATTERN.search(''.join(itertools.islice(fh, COMPANY_TITLE_LINES)))
+            except OSError:
+                continue
+            if match:
+                names[ticker] = match.group(1)
+                break
+    return names
+
+def load_data(input_format='csv'):
     print("Loading data...")
     
-    # Load Returns
+    # Load Returns (collected per file and concatenated once, rather than re-copying in the loop)
     returns_files = glob.glob(os.path.join(RETURNS_DIR, '*_returns.csv'))
-    returns_df = pd.DataFrame()
+    returns_frames = []
     for f in returns_files:
         try:
-            df = pd.read_csv(f)
-            returns_df = pd.concat([returns_df, df], ignore_index=True)
+            returns_frames.append(pd.read_csv(f, engine='pyarrow'))
         except:
             pass
+    returns_df = pd.concat(returns_frames, ignore_index=True) if returns_frames else pd.DataFrame()
             
     # Load Features (Signals)
     features_files = glob.glob(os.path.join(Signals_DIR, '*_features.csv'))
-    features_df = pd.DataFrame()
+    features_frames = []
     for f in features_files:
         try:
-            df = pd.read_csv(f)
-            features_df = pd.concat([features_df, df], ignore_index=True)
+            features_frames.append(pd.read_csv(f, engine='pyarrow'))
         except:
             pass
+    features_df = pd.concat(features_frames, ignore_index=True) if features_frames else pd.DataFrame()
 
     # Load Transcripts
+    if input_format == 'parquet':
+        if not os.path.isdir(TRANSCRIPTS_DATASET):
+            print(f"Parquet dataset '{TRANSCRIPTS_DATASET}' not found. Run parse_transcripts.py --format parquet first.")
+            return None, None, None
+        transcripts_df = pd.read_parquet(TRANSCRIPTS_DATASET)
+        # The partition key comes back categorical; plain strings match the returns / features keys
+        transcripts_df['ticker'] = transcripts_df['ticker'].astype(str)
+        return transcripts_df, returns_df, features_df
+        
     transcripts_files = glob.glob(os.path.join(TRANSCRIPTS_DIR, '*_transcript_data.csv'))
     transcript_data = []
     
@@ -108,8 +183,18 @@ def load_data():
     
     return transcripts_df, returns_df, features_df
 
-def build_index():
-    transcripts_df, returns_df, features_df = load_data()
+def rows_by_key(df):
+    """
+    Maps (ticker, quarter) to that row's remaining columns, for O(1) lookups while building the
+    index. The first row wins when a key repeats; rows with a missing key are never matched.
+    """
+    if df.empty:
+        return {}
+    df = df.dropna(subset=MERGE_KEYS).drop_duplicates(MERGE_KEYS)
+    return df.set_index(MERGE_KEYS).to_dict('index')
+
+def build_index(use_cache=True, input_format='csv'):
+    transcripts_df, returns_df, features_df = load_data(input_format)
     
     if transcripts_df is None:
         return
@@ -119,36 +204,25 @@ def build_index():
     
     total_rows = len(transcripts_df)
     
-    for idx, row in transcripts_df.iterrows():
-        print(f"Processing row {idx+1}/{total_rows}: {row.get('ticker')} {row.get('quarter')}")
-        
-        ticker = row.get('ticker')
-        quarter = row.get('quarter')
+    # Hash lookups instead of scanning the returns / features frames for every transcript
+    returns_by_key = rows_by_key(returns_df)
+    signals_by_key = rows_by_key(features_df)
+    
+    rows = transcripts_df[MERGE_KEYS + ['prepared_remarks', 'qa_management']].itertuples(index=False)
+    for idx, row in enumerate(rows):
+        ticker = row.ticker
+        quarter = row.quarter
+        print(f"Processing row {idx+1}/{total_rows}: {ticker} {quarter}")
         
         # Merge Metadata
         # Find matching returns
-        ret_row = pd.DataFrame()
-        if not returns_df.empty:
-             ret_row = returns_df[(returns_df['ticker'] == ticker) & (returns_df['quarter'] == quarter)]
-        
-        ret_1d = ret_row.iloc[0]['1_day_return'] if not ret_row.empty else None
-        ret_5d = ret_row.iloc[0]['5_day_return'] if not ret_row.empty else None
+        ret_row = returns_by_key.get((ticker, quarter))
+        ret_1d = ret_row['1_day_return'] if ret_row else None
+        ret_5d = ret_row['5_day_return'] if ret_row else None
         
-        # Find matching features
-        feat_row = pd.DataFrame()
-        if not features_df.empty:
-            feat_row = features_df[(features_df['ticker'] == ticker) & (features_df['quarter'] == quarter)]
-            
-        # Extract signal metadata
-        signals = {}
-        if not feat_row.empty:
-            for col in feat_row.columns:
-                if col not in ['ticker', 'quarter']:
-                    signals[col] = feat_row.iloc[0][col]
-                    
         # Chunking
         # Prepared Remarks
-        pr_text = row.get('prepared_remarks', '')
+        pr_text = row.prepared_remarks
         pr_chunks = chunk_text(pr_text)
         
         for chunk in pr_chunks:
@@ -158,12 +232,11 @@ def build_index():
                 'ticker': ticker,
                 'quarter': quarter,
                 'return_1d': ret_1d,
-                'return_5d': ret_5d,
-                'signals': signals
+                'return_5d': ret_5d
             })
             
         # QA Management (most important for tone usually)
-        qa_text = row.get('qa_management', '')
+        qa_text = row.qa_management
         qa_chunks = chunk_text(qa_text)
         
         for chunk in qa_chunks:
@@ -173,34 +246,90 @@ def build_index():
                 'ticker': ticker,
                 'quarter': quarter,
                 'return_1d': ret_1d,
-                'return_5d': ret_5d,
-                'signals': signals
+                'return_5d': ret_5d
             })
 
+    if not rag_data:
+        # Nothing to embed; an empty metadata table would have no columns and fail to load
+        print("No transcript text found to index; existing index files left unchanged.")
+        return
+        
     print(f"Generated {len(rag_data)} chunks. Creating embeddings (this may take a moment)...")
     
-    # Batch processing for embeddings could be faster, but simple loop for now
-    # Check cost: 10 files * ~50 chunks = 500 chunks. Very cheap.
+    # Row i of the matrix is the embedding of rag_data[i]
+    embeddings = np.zeros((len(rag_data), EMBEDDING_DIM), dtype=np.float32)
+    keys = [embedding_cache_key(item['text']) for item in rag_data]
     
-    # Batch processing
-    BATCH_SIZE = 100
-    for i in range(0, len(rag_data), BATCH_SIZE):
-        batch = rag_data[i:i+BATCH_SIZE]
-        texts = [item['text'] for item in batch]
-        
-        if i % 500 == 0:
-            print(f"Embedding {i}/{len(rag_data)}")
+    # Chunks embedded by an earlier build come from the cache; only new texts go to the API (once each)
+    cache = load_embedding_cache() if use_cache else {}
+    missing = {}
+    cached_count = 0
+    for i, (key, item) in enumerate(zip(keys, rag_data)):
+        if key in cache:
+            embeddings[i] = cache[key]
+            cached_count += 1
+        elif key not in missing:
+            missing[key] = item['text']
+    print(f"{cached_count} chunks cached, embedding {len(missing)} new texts...")
+    
+    missing_keys = list(missing)
+    texts = list(missing.values())
+    batch_starts = range(0, len(texts), EMBEDDING_BATCH_SIZE)
+    
+    # Batch processing; up to EMBEDDING_WORKERS requests in flight, map yields results in batch order
+    with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as pool:
+        batch_embeddings = pool.map(
+            get_embeddings_batch, 
+            (texts[i:i + EMBEDDING_BATCH_SIZE] for i in batch_starts)
+        )
+        for i, batch in zip(batch_starts, batch_embeddings):
+            if i % 500 == 0:
+                print(f"Embedding {i}/{len(texts)}")
+                
+            for key, embedding in zip(missing_keys[i:i + len(batch)], batch):
+                embedding = np.asarray(embedding, dtype=np.float32)
+                # Failed batches come back as zero vectors; leave those to be retried next build
+                if use_cache and embedding.any():
+                    cache[key] = embedding
+                missing[key] = embedding
+                
+    for i, key in enumerate(keys):
+        if key in missing:
+            embeddings[i] = missing[key]
             
-        embeddings = get_embeddings_batch(texts)
+    if use_cache and missing:
+        save_embedding_cache(cache)
         
-        for j, embedding in enumerate(embeddings):
-            batch[j]['embedding'] = embedding
+    # Store unit-length rows so query-time cosine similarity is a plain dot product;
+    # zero rows (failed embeddings) stay zero
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=norms > 0)
         
     print("Saving index...")
-    with open(OUTPUT_INDEX, 'wb') as f:
-        pickle.dump(rag_data, f)
+    # Every file is written under a temporary name and then swapped in. A running server has the
+    # old matrix memory-mapped; rewriting it in place would crash it (SIGBUS) or misalign it with
+    # the metadata, while a replaced file stays readable through the old mapping.
+    with open(OUTPUT_EMBEDDINGS + '.tmp', 'wb') as f:
+        np.save(f, embeddings)
+    pd.DataFrame(rag_data).to_parquet(OUTPUT_METADATA + '.tmp', index=False)
+    # Signals are stored once per transcript rather than copied onto each of its chunks
+    signals_df = pd.DataFrame.from_dict(signals_by_key, orient='index')
+    if not signals_df.empty:
+        signals_df = signals_df.rename_axis(MERGE_KEYS).reset_index()
+    signals_df.to_parquet(OUTPUT_SIGNALS + '.tmp', index=False)
+    company_names = load_company_names(sorted({item['ticker'] for item in rag_data}))
+    pd.DataFrame(list(company_names.items()), columns=['ticker', 'company']).to_parquet(OUTPUT_COMPANIES + '.tmp', index=False)
+    for path in (OUTPUT_EMBEDDINGS, OUTPUT_METADATA, OUTPUT_SIGNALS, OUTPUT_COMPANIES):
+        os.replace(path + '.tmp', path)
         
-    print(f"Index saved to {OUTPUT_INDEX}")
+    print(f"Index saved to {OUTPUT_EMBEDDINGS}, {OUTPUT_METADATA}, {OUTPUT_SIGNALS} and {OUTPUT_COMPANIES}")
 
 if __name__ == "__main__":
-    build_index()
+    parser = argparse.ArgumentParser(description='Build the RAG search index')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'Ignore and do not update the embedding cache ({EMBEDDING_CACHE_FILE})')
+    parser.add_argument('--input-format', choices=['csv', 'parquet'], default='csv',
+                        help=f"Read the per-ticker CSVs (default) or the dataset {TRANSCRIPTS_DATASET}; match parse_transcripts.py --format")
+    args = parser.parse_args()
+    
+    build_index(use_cache=not args.no_cache, input_format=args.input_format)
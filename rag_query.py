@@ -1,22 +1,71 @@
 import os
-import pickle
+import time
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv
 import re
 import argparse
-import json
-from typing import Dict, Any, List, Optional
+import orjson
+from typing import Dict, Any, Iterator, List, Optional
 
 load_dotenv()
 
 # --- Configuration ---
-INDEX_FILE = 'rag_index.pkl'
+# Written by rag_indexer.py: float32 embedding matrix plus row-aligned chunk metadata
+EMBEDDINGS_FILE = 'rag_index_embeddings.npy'
+METADATA_FILE = 'rag_index_meta.parquet'
+# Also written by rag_indexer.py: the company name of each indexed ticker
+COMPANIES_FILE = 'rag_index_companies.parquet'
+# Metadata needed to filter, rank and cite chunks (transcript signals live in a separate file and are not used here)
+METADATA_COLUMNS = ['text', 'section', 'ticker', 'quarter', 'return_1d']
 EMBEDDING_MODEL = "text-embedding-3-small"
 GENERATION_MODEL = "gpt-4o-mini"
 TOP_K = 10
+# Below this share of the index, scoring a gathered copy of the filtered rows beats one pass over all rows
+GATHER_MAX_FRACTION = 0.2
+# Filtered rows are gathered and scored this many at a time (~0.75 MB), so a query never copies
+# a large slice of the matrix no matter how big the index grows
+SCORE_TILE_ROWS = 128
+
+# Embedding requests from concurrent queries are coalesced into one API call
+EMBEDDING_BATCH_WINDOW_SECONDS = 0.01  # How long the first request of a batch waits for company
+EMBEDDING_BATCH_MAX = 64
+
+# Query result cache
+CACHE_MAX_ENTRIES = 256  # Least recently used results are evicted beyond this
+CACHE_TTL_SECONDS = 3600
+SEMANTIC_CACHE_THRESHOLD = 0.97  # Minimum cosine similarity of two query embeddings to reuse a result
+# Tickers, quarters and numbers must match exactly for a near-duplicate query to reuse a result,
+# since "AAPL Q2 2023" and "AAPL Q3 2023" embed almost identically but need different filters
+CACHE_GUARD_PATTERN = re.compile(r'\bQ[1-4]\s+\d{4}\b|\b[A-Z]{2,5}\b|[-+]?\d+(?:\.\d+)?%?')
+
+# Cues that a query may carry metadata filters (quarters, years, thresholds, return or section
+# wording); queries without them, or without a company mention, skip the LLM interpretation call
+FILTER_CUE_PATTERN = re.compile(
+    r'\d|%|\bq&a\b|\b(?:returns?|stock|shares?|price|up|down|gain(?:ed|s)?|drop(?:ped|s)?|'
+    r'fell|fall|rose|rise|jump(?:ed)?|surge[ds]?|plunge[ds]?|rall(?:y|ied)|beat|miss(?:ed)?|'
+    r'quarter(?:ly)?|fiscal|fy|prepared|remarks|analysts?|management|executives?)\b',
+    re.IGNORECASE
+)
+CAPITALIZED_WORD_PATTERN = re.compile(r"\b[A-Z][\w&.'-]*")
+# Capitalized words that open ordinary questions rather than name a company or ticker
+QUESTION_WORDS = frozenset({
+    'What', 'How', 'Which', 'Who', 'When', 'Where', 'Why', 'Did', 'Do', 'Does', 'Is', 'Are',
+    'Was', 'Were', 'Can', 'Could', 'Should', 'Would', 'Show', 'Find', 'List', 'Give', 'Tell',
+    'Summarize', 'Compare', 'Explain', 'Describe', 'Any', 'The', 'A', 'An', 'I', 'In', 'On', 'For'
+})
+# Everyday names that differ from the company names on the transcripts (Alphabet reports as such).
+# Indexed tickers and the first word of each indexed company's name are recognized on top of these.
+COMPANY_NAME_ALIASES = frozenset({'google'})
+INTERPRET_MAX_TOKENS = 200  # The filter JSON is well under this
+# Threads that run interpret_query alongside the query embedding (one per in-flight request)
+INTERPRET_WORKERS = 8
 
 # Initialize OpenAI Client
 try:
@@ -26,29 +75,229 @@ except Exception as e:
     # print("Ensure OPENAI_API_KEY is set.")
     client = None
 
+class QueryCache:
+    """
+    In-process cache of query_rag() results. Exact repeats are found by a hash of the query text,
+    near-duplicates by cosine similarity of the raw query embeddings. Entries expire after a TTL
+    and the least recently used ones are evicted once the cache is full.
+    """
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS,
+                 threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        # key -> (stored at, unit query embedding or None, guard tokens, result)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(query):
+        return hashlib.sha256(query.strip().encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def guard_tokens(query):
+        # Near-identical queries about different companies, quarters or thresholds must not share results
+        tokens = frozenset(m.group().upper().replace(' ', '') for m in CACHE_GUARD_PATTERN.finditer(query))
+        return tokens | company_mentions(query)
+
+    def _expire(self, now):
+        expired = [k for k, entry in self.entries.items() if now - entry[0] > self.ttl_seconds]
+        for k in expired:
+            del self.entries[k]
+
+    def get_exact(self, query):
+        with self.lock:
+            self._expire(time.monotonic())
+            entry = self.entries.get(self.key(query))
+            if entry is None:
+                return None
+            self.entries.move_to_end(self.key(query))
+            return entry[3]
+
+    def may_have_similar(self, query):
+        # get_similar only considers entries with the same guard tokens; without any it cannot hit
+        guard = self.guard_tokens(query)
+        with self.lock:
+            return any(entry[1] is not None and entry[2] == guard for entry in self.entries.values())
+
+    def get_similar(self, query, query_embedding):
+        query_vector = unit_vector(query_embedding)
+        if query_vector is None:
+            return None
+        guard = self.guard_tokens(query)
+        with self.lock:
+            self._expire(time.monotonic())
+            candidates = [(k, entry) for k, entry in self.entries.items()
+                          if entry[1] is not None and entry[2] == guard]
+            if not candidates:
+                return None
+            similarities = np.stack([entry[1] for _, entry in candidates]) @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            best_key, best_entry = candidates[best]
+            self.entries.move_to_end(best_key)
+            return best_entry[3]
+
+    def put(self, query, query_embedding, result):
+        with self.lock:
+            key = self.key(query)
+            self.entries[key] = (time.monotonic(), unit_vector(query_embedding), self.guard_tokens(query), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+def unit_vector(embedding):
+    # float32 unit-length copy of an embedding, or None for a zero (failed) embedding
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else None
+
+QUERY_CACHE = QueryCache()
+
+# Process-wide index, loaded on first use and shared by every request
+INDEX = {'meta': None, 'emb': None, 'columns': None, 'company_words': COMPANY_NAME_ALIASES}
+INDEX_LOCK = threading.Lock()
+
+# Metadata columns that filter_data compares against
+FILTER_COLUMNS = ['ticker', 'quarter', 'section']
+
+def build_filter_columns(meta: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """
+    Extracts the filterable metadata as plain numpy arrays: fixed-width unicode for the string
+    columns (compared in native code, no per-row Python objects) and float64 returns with NaN
+    where the return is missing.
+    """
+    columns = {name: meta[name].fillna('').to_numpy(dtype=str) for name in FILTER_COLUMNS}
+    columns['return_1d'] = meta['return_1d'].to_numpy(dtype=np.float64, na_value=np.nan)
+    return columns
+
+def load_company_words(tickers: np.ndarray) -> frozenset:
+    """
+    Lower-cased words that name an indexed company: each ticker, and the first word of its company
+    name ("micron" for "Micron Technology Inc") from COMPANIES_FILE when the index has one.
+    """
+    words = set(np.char.lower(np.unique(tickers)).tolist()) - {''}
+    if os.path.exists(COMPANIES_FILE):
+        try:
+            for name in pd.read_parquet(COMPANIES_FILE, columns=['company'])['company'].dropna():
+                first_word = re.match(r'\w+', name.lower())
+                if first_word:
+                    words.add(first_word.group())
+        except Exception as e:
+            print(f"Warning: could not read company names {COMPANIES_FILE}: {e}")
+    return frozenset(words)
+
 def load_index():
-    if not os.path.exists(INDEX_FILE):
-        print(f"Index file {INDEX_FILE} not found. Run rag_indexer.py first.")
-        return None
-    with open(INDEX_FILE, 'rb') as f:
-        return pickle.load(f)
+    """
+    Returns (chunk metadata DataFrame, embedding matrix, filter column arrays), or
+    (None, None, None) if the index is missing.
+    The index is read from disk once per process; the matrix is memory-mapped, so its pages come
+    from the OS cache. A process that has loaded the index keeps serving it after rag_indexer.py
+    rebuilds it (the indexer swaps in new files, so the old mapping stays valid); restart the
+    server to pick up a rebuilt index. A missing index is retried on the next query.
+    """
+    with INDEX_LOCK:
+        if INDEX['meta'] is None:
+            if not (os.path.exists(EMBEDDINGS_FILE) and os.path.exists(METADATA_FILE)):
+                print(f"Index files {EMBEDDINGS_FILE} / {METADATA_FILE} not found. Run rag_indexer.py first.")
+                return None, None, None
+            INDEX['emb'] = np.load(EMBEDDINGS_FILE, mmap_mode='r')
+            INDEX['meta'] = pd.read_parquet(METADATA_FILE, columns=METADATA_COLUMNS)
+            INDEX['columns'] = build_filter_columns(INDEX['meta'])
+            INDEX['company_words'] = COMPANY_NAME_ALIASES | load_company_words(INDEX['columns']['ticker'])
+        return INDEX['meta'], INDEX['emb'], INDEX['columns']
+
+def index_records(meta: pd.DataFrame, positions) -> List[Dict[str, Any]]:
+    """Materializes the metadata rows at `positions` as dicts (missing returns as None)."""
+    records = meta.iloc[positions].to_dict('records')
+    for item in records:
+        if pd.isna(item['return_1d']):
+            item['return_1d'] = None
+    return records
+
+class EmbeddingBatcher:
+    """
+    Coalesces embedding requests from concurrent queries (Flask serves each request on its own
+    thread) into a single embeddings API call. A background thread collects whatever arrives
+    within a short window, or while the previous call is in flight, and fans the results out.
+    """
+    def __init__(self, window_seconds=EMBEDDING_BATCH_WINDOW_SECONDS, max_batch=EMBEDDING_BATCH_MAX):
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def embed(self, text):
+        future = Future()
+        self.pending.put((text, future))
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+                self.worker.start()
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.window_seconds
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            
+            try:
+                response = client.embeddings.create(input=[text for text, _ in batch], model=EMBEDDING_MODEL)
+                for (_, future), item in zip(batch, response.data):
+                    future.set_result(item.embedding)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+EMBEDDING_BATCHER = EmbeddingBatcher()
 
 def get_embedding(text):
     if not client:
         return [0.0] * 1536
     text = text.replace("\n", " ")
     try:
-        return client.embeddings.create(input=[text], model=EMBEDDING_MODEL).data[0].embedding
+        return EMBEDDING_BATCHER.embed(text)
     except Exception as e:
         print(f"Error getting embedding: {e}")
         return [0.0] * 1536
 
+def company_mentions(query):
+    """
+    Lower-cased words of `query` that may name a company: capitalized words other than question
+    words, and indexed company names or tickers in any case ("how is micron doing").
+    """
+    mentions = {word.lower() for word in CAPITALIZED_WORD_PATTERN.findall(query) if word not in QUESTION_WORDS}
+    mentions.update(query_terms(query) & INDEX['company_words'])
+    return frozenset(mentions)
+
+def has_filter_cues(query):
+    """
+    Cheap pre-scan for interpret_query: False when the query is plain free text that the LLM
+    would only turn into empty filters (no company, ticker, quarter, number or return wording).
+    """
+    if FILTER_CUE_PATTERN.search(query):
+        return True
+    return bool(company_mentions(query))
+
+INTERPRET_POOL = ThreadPoolExecutor(max_workers=INTERPRET_WORKERS, thread_name_prefix='interpret')
+
+def query_terms(text):
+    # Lowercased word set, for telling whether a rewritten search text says anything new
+    return frozenset(re.findall(r'\w+', text.lower()))
+
 def interpret_query(query):
     """
     Uses LLM to extract structured filters from the natural language query.
     Returns a dictionary of filters and the core semantic search query.
     """
-    if not client:
+    if not client or not has_filter_cues(query):
         return {"filters": {}, "search_query": query}
 
     system_prompt = """
@@ -82,79 +331,165 @@ def interpret_query(query):
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": query}
             ],
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            temperature=0,
+            max_tokens=INTERPRET_MAX_TOKENS
         )
-        return json.loads(response.choices[0].message.content) # JSON parsing
+        return orjson.loads(response.choices[0].message.content) # JSON parsing
     except Exception as e:
         print(f"Error interpreting query: {e}")
         return {"filters": {}, "search_query": query}
 
-def filter_data(data, filters):
-    filtered_data = []
-    for item in data:
-        # Ticker Filter
-        if filters.get('ticker') and item['ticker'] != filters['ticker']:
-            continue
-            
-        # Quarter Filter
-        if filters.get('quarter') and item['quarter'] != filters['quarter']:
-            continue
-            
-        # Section Filter
-        if filters.get('section') and item['section'] != filters['section']:
-            continue
+def filter_data(columns, filters):
+    # Returns the chunk positions (rows of the metadata and embedding matrix) that pass the
+    # filters, computed as one boolean mask over the arrays from build_filter_columns
+    r1d = columns['return_1d']
+    mask = np.ones(len(r1d), dtype=bool)
+    
+    # Ticker / Quarter / Section Filters
+    for column in FILTER_COLUMNS:
+        if filters.get(column):
+            mask &= (columns[column] == filters[column])
             
-        # Return Filters
-        r1d = item['return_1d']
-        if r1d is not None:
-            if filters.get('return_1d_min') is not None and r1d < filters['return_1d_min']:
-                continue
-            if filters.get('return_1d_max') is not None and r1d > filters['return_1d_max']:
-                continue
-        elif filters.get('return_1d_min') is not None or filters.get('return_1d_max') is not None:
-             # If filter requires return data but item has none, skip it
-             continue
-             
-        filtered_data.append(item)
-    return filtered_data
+    # Return Filters (NaN compares False, so chunks without return data are dropped too)
+    if filters.get('return_1d_min') is not None:
+        mask &= (r1d >= filters['return_1d_min'])
+    if filters.get('return_1d_max') is not None:
+        mask &= (r1d <= filters['return_1d_max'])
+        
+    return np.flatnonzero(mask)
+
+def cosine_scores(query_embedding, embeddings: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity of one query vector against the rows of `embeddings` at `positions`, as a
+    single float32 matrix-vector product. The indexer stores unit-length rows (zero rows for
+    failed embeddings, which score 0), so only the query needs normalizing.
+    
+    A selective filter gathers just its rows, in small reused tiles; a broad one scores the whole
+    matrix in one streaming pass and then picks, which is cheaper than copying most of the matrix.
+    """
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    if query_norm > 0:
+        query = query / query_norm
+    if len(positions) > GATHER_MAX_FRACTION * len(embeddings):
+        return (embeddings @ query)[positions]
+        
+    scores = np.empty(len(positions), dtype=np.float32)
+    tile = np.empty((min(SCORE_TILE_ROWS, len(positions)), embeddings.shape[1]), dtype=np.float32)
+    for start in range(0, len(positions), SCORE_TILE_ROWS):
+        tile_positions = positions[start:start + SCORE_TILE_ROWS]
+        rows = tile[:len(tile_positions)]
+        np.take(embeddings, tile_positions, axis=0, out=rows)
+        np.dot(rows, query, out=scores[start:start + len(tile_positions)])
+    return scores
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first. argpartition avoids sorting every score;
+    ties keep their original order, as with a stable descending sort.
+    """
+    if len(scores) > k:
+        candidates = np.sort(np.argpartition(-scores, k)[:k])
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
 
 def query_rag(query: str) -> Dict[str, Any]:
     """
     Executes the RAG pipeline for a given query.
     Returns a dictionary with the answer, context items, and metadata.
     """
+    result = {}
+    answer_parts = []
+    for event in query_rag_stream(query):
+        if "error" in event:
+            return event
+        if "delta" in event:
+            answer_parts.append(event["delta"])
+        elif "context" in event:
+            result.update(event)
+    return {"answer": "".join(answer_parts), **result}
+
+def query_rag_stream(query: str) -> Iterator[Dict[str, Any]]:
+    """
+    Executes the RAG pipeline for a given query, streaming the answer as it is generated.
+    Yields one {"filters", "context"} event once retrieval is done, then {"delta": text} pieces
+    of the answer and a final {"done": True}; or an {"error": message} event on failure.
+    """
     if not client:
-        return {"error": "OpenAI client not initialized (check API key)."}
+        yield {"error": "OpenAI client not initialized (check API key)."}
+        return
 
-    data = load_index()
-    if not data:
-        return {"error": f"Index file '{INDEX_FILE}' not found."}
+    meta, embeddings, columns = load_index()
+    if meta is None:
+        yield {"error": f"Index files '{EMBEDDINGS_FILE}' / '{METADATA_FILE}' not found."}
+        return
 
+    # Repeated or near-duplicate questions skip the LLM round trips entirely
+    cached = QUERY_CACHE.get_exact(query)
+    if cached is not None:
+        print(f"Cache hit for query: '{query}'")
+        yield from result_events(cached)
+        return
+    
+    # Filter interpretation (an LLM round trip) does not depend on the query embedding. When no
+    # cached entry could be a semantic hit, both requests are in flight together; otherwise the
+    # cache is checked first, so a hit never pays for an interpretation call it would discard.
+    parsed_future = None
+    if not QUERY_CACHE.may_have_similar(query):
+        parsed_future = INTERPRET_POOL.submit(interpret_query, query)
+    query_embedding = get_embedding(query)
+    cached = QUERY_CACHE.get_similar(query, query_embedding)
+    if cached is not None:
+        print(f"Semantic cache hit for query: '{query}'")
+        if parsed_future is not None:
+            parsed_future.cancel()
+        yield from result_events(cached)
+        return
+    
     print(f"Interpreting query: '{query}'...")
-    parsed = interpret_query(query)
+    parsed = parsed_future.result() if parsed_future is not None else interpret_query(query)
+    result = yield from run_rag_pipeline(query, query_embedding, parsed, meta, embeddings, columns)
+    if result is not None:
+        QUERY_CACHE.put(query, query_embedding, result)
+
+def result_events(result: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Replays a finished result as stream events."""
+    yield {"filters": result["filters"], "context": result["context"]}
+    yield {"delta": result["answer"]}
+    yield {"done": True}
+
+def run_rag_pipeline(query: str, query_embedding, parsed, meta, embeddings, columns):
+    """
+    Filters, ranks and answers a query that was not found in the cache, yielding stream events
+    (see query_rag_stream). `query_embedding` is the embedding of the raw query text and `parsed`
+    the output of interpret_query. Returns the complete result for caching, or None if generation failed.
+    """
     filters = parsed.get('filters', {})
     search_text = parsed.get('search_query', query)
     
     # 1. Filter
-    filtered_data = filter_data(data, filters)
+    filtered_positions = filter_data(columns, filters)
     
-    if not filtered_data:
-        return {
+    if len(filtered_positions) == 0:
+        result = {
             "answer": "No matching data found with the inferred filters.",
             "filters": filters,
             "context": []
         }
+        yield from result_events(result)
+        return result
 
-    # 2. Rank by Embedding Similarity
-    query_embedding = get_embedding(search_text)
+    # 2. Rank by Embedding Similarity (reusing the raw query embedding unless the search text
+    # brings in different words; reordering or recasing the same words does not warrant a new call)
+    if query_terms(search_text) != query_terms(query):
+        query_embedding = get_embedding(search_text)
     
-    similarities = []
-    for item in filtered_data:
-        sim = cosine_similarity([query_embedding], [item['embedding']])[0][0]
-        similarities.append((sim, item))
-        
-    similarities.sort(key=lambda x: x[0], reverse=True)
-    top_results = similarities[:TOP_K]
+    # Exact brute-force ranking over the filtered chunks, then a partial sort for the top k
+    scores = cosine_scores(query_embedding, embeddings, filtered_positions)
+    top = top_k_indices(scores, TOP_K)
+    top_results = list(zip(scores[top], index_records(meta, filtered_positions[top])))
     
     # 3. Generate Answer
     context_items = []
@@ -174,6 +509,9 @@ def query_rag(query: str) -> Dict[str, Any]:
             "section": item.get('section', 'unknown')
         })
         
+    # Sources are known before the answer, so the caller can show them while it streams
+    yield {"filters": filters, "context": context_items}
+        
     print("Generating answer...")
     
     system_prompt = f"""
@@ -185,24 +523,32 @@ def query_rag(query: str) -> Dict[str, Any]:
     """
     
     try:
-        response = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model=GENERATION_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": f"Context:\n{context_text}\n\nQuestion: {query}"}
-            ]
+            ],
+            stream=True
         )
-        answer = response.choices[0].message.content
-        
-        return {
-            "answer": answer,
-            "filters": filters,
-            "context": context_items
-        }
+        answer_parts = []
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                answer_parts.append(delta)
+                yield {"delta": delta}
         
     except Exception as e:
         print(f"Error generating answer: {e}")
-        return {"error": f"Error generating answer: {str(e)}"}
+        yield {"error": f"Error generating answer: {str(e)}"}
+        return None
+        
+    yield {"done": True}
+    return {
+        "answer": "".join(answer_parts),
+        "filters": filters,
+        "context": context_items
+    }
 
 def search(query):
     """Legacy CLI entry point"""